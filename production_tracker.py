@@ -1,18 +1,76 @@
 # production_tracker.py
 import sqlite3
+import threading
+import numpy as np
 import pandas as pd
 import streamlit as st
-from datetime import datetime
-from sklearn.ensemble import RandomForestRegressor, IsolationForest
-from sklearn.preprocessing import LabelEncoder
+from joblib import parallel_backend
+from sklearn.ensemble import HistGradientBoostingRegressor, IsolationForest
+
+# Optional GPU anomaly detector (see requirements-gpu.txt); importing cuML can
+# fail with more than ImportError when no CUDA device is available
+try:
+    import cupy
+    from cuml.ensemble import IsolationForest as GPUIsolationForest
+except Exception:
+    GPUIsolationForest = None
+
+# Logs needed before fitting the anomaly detector on the GPU pays off
+GPU_MIN_ROWS = 10_000
 
 # -----------------------------
 # Database Setup
 # -----------------------------
+DB_PATH = "production_tracker.db"
+SCHEMA_VERSION = 2
+
+@st.cache_resource
+def get_conn():
+    # One connection per process, shared by every session and rerun
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-20000;
+    PRAGMA mmap_size=268435456;
+    PRAGMA optimize=0x10002;
+    """)
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    # Serializes writes on the shared connection
+    return threading.Lock()
+
+@st.cache_resource
 def init_db():
-    conn = sqlite3.connect("production_tracker.db")
+    conn = get_conn()
     cursor = conn.cursor()
 
+    # Already created and seeded
+    if cursor.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    # Create, migrate, clean up, index and seed in a single transaction; roll it
+    # back on failure so the shared connection is left clean for the next rerun
+    cursor.execute("BEGIN")
+    try:
+        _create_schema(cursor)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    cursor.execute("PRAGMA optimize")
+
+def _create_schema(cursor):
+    # Logs created before schema version 2 store duration as FLOAT; move them
+    # aside so they can be copied into the INTEGER table created below
+    log_columns = {row[1]: row[2] for row in cursor.execute("PRAGMA table_info(ActivityLogs)")}
+    migrate_logs = log_columns.get("duration_minutes", "INTEGER") != "INTEGER"
+    if migrate_logs:
+        cursor.execute("ALTER TABLE ActivityLogs RENAME TO ActivityLogs_old;")
+
     # Create tables
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS Lines (
@@ -50,7 +108,7 @@ def init_db():
         part_description TEXT,
         start_time TEXT,
         end_time TEXT,
-        duration_minutes FLOAT,
+        duration_minutes INTEGER NOT NULL,
         notes TEXT,
         FOREIGN KEY(line_id) REFERENCES Lines(line_id),
         FOREIGN KEY(machine_id) REFERENCES Machines(machine_id),
@@ -58,6 +116,15 @@ def init_db():
     );
     """)
 
+    if migrate_logs:
+        cursor.execute("""
+        INSERT INTO ActivityLogs
+        SELECT log_id, line_id, machine_id, operator_id, activity_type, part_description,
+               start_time, end_time, CAST(ROUND(COALESCE(duration_minutes, 0)) AS INTEGER), notes
+        FROM ActivityLogs_old;
+        """)
+        cursor.execute("DROP TABLE ActivityLogs_old;")
+
     # Predefined machine list
     machines = [
         ("Rougher Roller Turner", "Rougher"),
@@ -81,17 +148,190 @@ def init_db():
         ("Sealer Unit", "Finisher")
     ]
 
-    # Insert lines and machines
-    for i in range(1, 23):  # R1 to R22
-        line_id = f"R{i}"
-        cursor.execute("INSERT OR IGNORE INTO Lines (line_id, description) VALUES (?, ?)",
-                       (line_id, f"Production Line {i}"))
-        for machine_name, machine_type in machines:
-            cursor.execute("INSERT INTO Machines (line_id, machine_name, machine_type) VALUES (?, ?, ?)",
-                           (line_id, machine_name, machine_type))
+    # Older databases may hold duplicate operators; keep the first one per
+    # (name, line) so the unique index below can be built
+    cursor.execute("""
+    UPDATE ActivityLogs SET operator_id = (
+        SELECT MIN(o2.operator_id) FROM Operators o1
+        JOIN Operators o2 ON o2.name = o1.name AND o2.assigned_line = o1.assigned_line
+        WHERE o1.operator_id = ActivityLogs.operator_id
+    ) WHERE operator_id IN (SELECT operator_id FROM Operators);
+    """)
+    cursor.execute("""
+    DELETE FROM Operators WHERE operator_id NOT IN (
+        SELECT MIN(operator_id) FROM Operators GROUP BY name, assigned_line
+    );
+    """)
+
+    # Same for machines, which were re-inserted on every start
+    cursor.execute("""
+    UPDATE ActivityLogs SET machine_id = (
+        SELECT MIN(m2.machine_id) FROM Machines m1
+        JOIN Machines m2 ON m2.line_id = m1.line_id AND m2.machine_name = m1.machine_name
+        WHERE m1.machine_id = ActivityLogs.machine_id
+    ) WHERE machine_id IN (SELECT machine_id FROM Machines);
+    """)
+    cursor.execute("""
+    DELETE FROM Machines WHERE machine_id NOT IN (
+        SELECT MIN(machine_id) FROM Machines GROUP BY line_id, machine_name
+    );
+    """)
 
-    conn.commit()
-    conn.close()
+    # Index foreign keys and the operator lookup; the unique machine index
+    # also serves line_id lookups through its prefix
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_machines_line_name ON Machines(line_id, machine_name);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_operators_line ON Operators(assigned_line);")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_operators_name_line ON Operators(name, assigned_line);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_machine ON ActivityLogs(machine_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_operator ON ActivityLogs(operator_id);")
+    # Covers the ML feature read, and line_id lookups through its prefix
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_logs_ml
+    ON ActivityLogs(line_id, activity_type, part_description, duration_minutes);
+    """)
+
+    # Insert lines and machines (R1 to R22)
+    lines_rows = [(f"R{i}", f"Production Line {i}") for i in range(1, 23)]
+    machines_rows = [(f"R{i}", machine_name, machine_type)
+                     for i in range(1, 23) for machine_name, machine_type in machines]
+    cursor.executemany("INSERT OR IGNORE INTO Lines (line_id, description) VALUES (?, ?)", lines_rows)
+    cursor.executemany("INSERT OR IGNORE INTO Machines (line_id, machine_name, machine_type) VALUES (?, ?, ?)",
+                       machines_rows)
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+@st.cache_data
+def load_topology():
+    # Lines and machines are fixed once seeded, so read them once per process
+    conn = get_conn()
+    lines = [r[0] for r in conn.execute("SELECT line_id FROM Lines ORDER BY rowid")]
+    machines_by_line = {}
+    machine_ids = {}
+    rows = conn.execute("SELECT line_id, machine_name, machine_id FROM Machines ORDER BY machine_id")
+    for line_id, machine_name, machine_id in rows:
+        machines_by_line.setdefault(line_id, []).append(machine_name)
+        machine_ids[(line_id, machine_name)] = machine_id
+    return lines, machines_by_line, machine_ids
+
+# -----------------------------
+# AI Models
+# -----------------------------
+def _fit_models(X, y):
+    # Fit on threads rather than worker processes
+    with parallel_backend("threading", n_jobs=-1):
+        # Train predictive model; three low-cardinality features need only shallow trees
+        model = HistGradientBoostingRegressor(max_iter=50, max_depth=6, max_leaf_nodes=31, min_samples_leaf=5,
+                                              early_stopping=False)
+        model.fit(X, y)
+
+        # Train anomaly detector, on the GPU for large logs when cuML is installed
+        if GPUIsolationForest is not None and len(X) > GPU_MIN_ROWS:
+            anomaly_model = GPUIsolationForest(n_estimators=50, max_samples=min(256, len(X)), contamination=0.1)
+            anomaly_model.fit(cupy.asarray(X, dtype=cupy.float32))
+        else:
+            anomaly_model = IsolationForest(n_estimators=50, max_samples=min(256, len(X)), contamination=0.1,
+                                            n_jobs=-1, bootstrap=False)
+            anomaly_model.fit(X)
+
+    return model, anomaly_model
+
+@st.cache_resource(max_entries=1)
+def _base_ml_state(n_rows, max_log_id, _conn):
+    # Fit shared by every session; n_rows and max_log_id key the cache, so logs are
+    # only re-read and models refit once logs were added; _conn is skipped by
+    # Streamlit's hashing
+    logs = pd.read_sql_query(
+        "SELECT line_id, activity_type, part_description, duration_minutes FROM ActivityLogs",
+        _conn, dtype={"duration_minutes": "float32"})
+    columns = [
+        logs["line_id"],
+        logs["activity_type"],
+        logs["part_description"].fillna("Unknown"),
+    ]
+
+    # Encode categorical features, keeping a value -> code dict per feature;
+    # codes fit int16 unless a feature has more classes than that holds
+    columns = [values.astype("category") for values in columns]
+    n_classes = max(len(values.cat.categories) for values in columns)
+    dtype = np.int16 if n_classes <= np.iinfo(np.int16).max else np.int32
+    cats = {}
+    X = np.empty((len(logs), 3), dtype=dtype)
+    for j, (key, values) in enumerate(zip(("line", "activity", "part"), columns)):
+        cats[key] = {value: code for code, value in enumerate(values.cat.categories)}
+        X[:, j] = values.cat.codes.to_numpy(dtype=dtype)
+    y = logs["duration_minutes"].to_numpy(dtype=np.float32)
+
+    model, anomaly_model = _fit_models(X, y)
+    return {"cats": cats, "X": X, "y": y, "fit_len": len(y),
+            "model": model, "anomaly_model": anomaly_model}
+
+def _session_ml_state(base):
+    # Sessions append to their own copy of the shared arrays and categories; the
+    # fitted models are only replaced, never modified, so they can be shared
+    return {"cats": {key: cats.copy() for key, cats in base["cats"].items()},
+            "X": base["X"].copy(), "y": base["y"].copy(), "fit_len": base["fit_len"],
+            "model": base["model"], "anomaly_model": base["anomaly_model"]}
+
+def _append_log(ml, line_id, activity_type, part_description, duration):
+    # Encode the new row, giving unseen classes the next free code so existing
+    # codes stay valid
+    row = [ml["cats"][key].setdefault(value, len(ml["cats"][key]))
+           for key, value in (("line", line_id), ("activity", activity_type), ("part", part_description))]
+    X = ml["X"]
+    if max(row) > np.iinfo(X.dtype).max:
+        X = X.astype(np.int32)
+    ml["X"] = np.concatenate([X, np.array([row], dtype=X.dtype)])
+    ml["y"] = np.append(ml["y"], np.float32(duration))
+
+    # Refit only once the data has doubled since the last fit
+    if len(ml["y"]) > 2 * ml["fit_len"]:
+        ml["model"], ml["anomaly_model"] = _fit_models(ml["X"], ml["y"])
+        ml["fit_len"] = len(ml["y"])
+
+# -----------------------------
+# Time Parsing
+# -----------------------------
+def _hhmm_minutes(b0, b1, b2, b3, b4):
+    # Minutes since midnight for the five bytes of "HH:MM", or -1 if invalid;
+    # shared by _parse_hhmm and the batch kernel
+    h1, h2, m1, m2 = b0 - 48, b1 - 48, b3 - 48, b4 - 48
+    if b2 != 58 or not (0 <= h1 <= 9 and 0 <= h2 <= 9 and 0 <= m1 <= 9 and 0 <= m2 <= 9):
+        return -1
+    hours = h1 * 10 + h2
+    minutes = m1 * 10 + m2
+    if hours > 23 or minutes > 59:
+        return -1
+    return hours * 60 + minutes
+
+def _parse_hhmm(s):
+    # Minutes since midnight for a strict "HH:MM" string, or None if invalid
+    b = s.encode()
+    minutes = _hhmm_minutes(*b) if len(b) == 5 else -1
+    return None if minutes < 0 else minutes
+
+@st.cache_resource
+def _hhmm_kernel():
+    # numba is only imported here, so the interactive app neither loads nor needs
+    # it; without numba the kernel runs as plain Python
+    try:
+        from numba import njit
+    except ImportError:
+        def njit(func):
+            return func
+    hhmm_minutes = njit(_hhmm_minutes)
+
+    @njit
+    def kernel(buf):
+        out = np.empty(buf.shape[0], np.int32)
+        for i in range(buf.shape[0]):
+            out[i] = hhmm_minutes(int(buf[i, 0]), int(buf[i, 1]), int(buf[i, 2]), int(buf[i, 3]), int(buf[i, 4]))
+        return out
+
+    return kernel
+
+def parse_hhmm_batch(times):
+    # Batch form of _parse_hhmm for bulk imports; -1 marks invalid entries
+    raw = np.array([t.encode() if len(t) == 5 else b"" for t in times], dtype="S5")
+    return _hhmm_kernel()(raw.view(np.uint8).reshape(-1, 5))
 
 # -----------------------------
 # Streamlit App
@@ -99,19 +339,17 @@ def init_db():
 def app():
     st.title("🏭 AI-Powered Production Tracker")
 
-    conn = sqlite3.connect("production_tracker.db")
+    conn = get_conn()
     cursor = conn.cursor()
 
     # Fetch lines and machines
-    lines = pd.read_sql("SELECT * FROM Lines", conn)
-    machines = pd.read_sql("SELECT * FROM Machines", conn)
-    operators = pd.read_sql("SELECT * FROM Operators", conn)
+    lines, machines_by_line, machine_ids = load_topology()
 
     # Activity Logging Form
     st.subheader("Log Activity")
-    line_id = st.selectbox("Select Line", lines["line_id"].tolist())
+    line_id = st.selectbox("Select Line", lines)
     part_description = st.text_input("Part Description")
-    machine_name = st.selectbox("Select Machine", machines[machines["line_id"] == line_id]["machine_name"].tolist())
+    machine_name = st.selectbox("Select Machine", machines_by_line[line_id])
     operator_name = st.text_input("Operator Name")
     activity_type = st.selectbox("Activity Type", ["Setup", "Calibration", "Cleaning", "Trial Run", "Downtime"])
     start_time_str = st.text_input("Enter Start Time (HH:MM)", "08:00")
@@ -119,78 +357,83 @@ def app():
     notes = st.text_area("Notes / Downtime Reason")
 
     if st.button("Submit Activity"):
-        # Ensure operator exists
-        cursor.execute("INSERT OR IGNORE INTO Operators (name, assigned_line) VALUES (?, ?)", (operator_name, line_id))
-        conn.commit()
+        # Parse times and calculate duration (wrapping past midnight)
+        start_minutes = _parse_hhmm(start_time_str)
+        end_minutes = _parse_hhmm(end_time_str)
+        if start_minutes is None or end_minutes is None:
+            st.error("⚠️ Please enter time in HH:MM format (e.g., 08:30).")
+        else:
+            duration = (end_minutes - start_minutes) % (24 * 60)
+            machine_id = machine_ids[(line_id, machine_name)]
+
+            # Operator and log are written in one transaction, committed on exit
+            with get_write_lock(), conn:
+                # Ensure operator exists, only looking it up when it already did
+                cursor.execute("INSERT OR IGNORE INTO Operators (name, assigned_line) VALUES (?, ?)",
+                               (operator_name, line_id))
+                if cursor.rowcount:
+                    operator_id = cursor.lastrowid
+                else:
+                    operator_id = cursor.execute("SELECT operator_id FROM Operators WHERE name=? AND assigned_line=?",
+                                                 (operator_name, line_id)).fetchone()[0]
+
+                # Insert log
+                cursor.execute("""
+                INSERT INTO ActivityLogs (line_id, machine_id, operator_id, activity_type, part_description, start_time, end_time, duration_minutes, notes)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (line_id, machine_id, operator_id, activity_type, part_description,
+                      start_time_str, end_time_str, duration, notes))
 
-        # Get IDs
-        machine_id = machines[(machines["line_id"] == line_id) & (machines["machine_name"] == machine_name)]["machine_id"].values[0]
-        operator_id = pd.read_sql("SELECT operator_id FROM Operators WHERE name=? AND assigned_line=?", conn, params=(operator_name, line_id))["operator_id"].values[0]
-
-        # Parse times and calculate duration
-        try:
-            start_time = datetime.strptime(start_time_str, "%H:%M")
-            end_time = datetime.strptime(end_time_str, "%H:%M")
-            duration = (end_time - start_time).seconds / 60
-
-            # Insert log
-            cursor.execute("""
-            INSERT INTO ActivityLogs (line_id, machine_id, operator_id, activity_type, part_description, start_time, end_time, duration_minutes, notes)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (line_id, machine_id, operator_id, activity_type, part_description,
-                  start_time_str, end_time_str, duration, notes))
-            conn.commit()
+            if "ml" in st.session_state:
+                _append_log(st.session_state["ml"], line_id, activity_type, part_description, duration)
             st.success("✅ Activity logged successfully!")
-        except ValueError:
-            st.error("⚠️ Please enter time in HH:MM format (e.g., 08:30).")
 
     # Show Logs
     st.subheader("Activity Logs")
-    logs = pd.read_sql("SELECT * FROM ActivityLogs", conn)
-    st.dataframe(logs)
+    n_logs, max_log_id = cursor.execute("SELECT COUNT(*), MAX(log_id) FROM ActivityLogs").fetchone()
+    logs_view = pd.read_sql_query("""
+    SELECT log_id, line_id, machine_id, activity_type, part_description, start_time, end_time, duration_minutes, notes
+    FROM ActivityLogs ORDER BY log_id DESC LIMIT 200
+    """, conn)
+    st.dataframe(logs_view)
+    st.caption(f"Showing the latest {len(logs_view)} of {n_logs} logs")
 
     # AI Insights
     st.subheader("AI Insights")
-    if not logs.empty:
-        # Encode categorical features
-        le_line = LabelEncoder()
-        le_activity = LabelEncoder()
-        le_part = LabelEncoder()
-
-        logs["line_enc"] = le_line.fit_transform(logs["line_id"])
-        logs["activity_enc"] = le_activity.fit_transform(logs["activity_type"])
-        logs["part_enc"] = le_part.fit_transform(logs["part_description"].fillna("Unknown"))
-
-        X = logs[["line_enc", "activity_enc", "part_enc"]]
-        y = logs["duration_minutes"]
-
-        # Train predictive model
-        model = RandomForestRegressor()
-        model.fit(X, y)
-
-        # Train anomaly detector
-        anomaly_model = IsolationForest(contamination=0.1)
-        anomaly_model.fit(X)
+    if n_logs:
+        # Start from the shared fit when this session has no models yet or other
+        # sessions added logs
+        if "ml" not in st.session_state or len(st.session_state["ml"]["y"]) != n_logs:
+            st.session_state["ml"] = _session_ml_state(_base_ml_state(n_logs, max_log_id, conn))
+        ml = st.session_state["ml"]
+        model, anomaly_model = ml["model"], ml["anomaly_model"]
+        line_cats, act_cats, part_cats = ml["cats"]["line"], ml["cats"]["activity"], ml["cats"]["part"]
+        if "pred_buf" not in st.session_state:
+            st.session_state["pred_buf"] = np.empty((1, 3), dtype=np.float32)
+        buf = st.session_state["pred_buf"]
 
         # Prediction UI
-        pred_line = st.selectbox("Predict for Line", lines["line_id"].tolist())
+        pred_line = st.selectbox("Predict for Line", lines)
         pred_activity = st.selectbox("Predict for Activity", ["Setup", "Calibration", "Cleaning", "Trial Run", "Downtime"])
         pred_part = st.text_input("Predict for Part Description")
 
         if st.button("Predict Setup Time"):
             try:
-                pred = model.predict([[le_line.transform([pred_line])[0],
-                                       le_activity.transform([pred_activity])[0],
-                                       le_part.transform([pred_part])[0] if pred_part in le_part.classes_ else 0]])
+                buf[0, 0] = line_cats[pred_line]
+                buf[0, 1] = act_cats[pred_activity]
+                buf[0, 2] = part_cats.get(pred_part, 0)
+                pred = model.predict(buf)
                 st.info(f"Predicted setup time: {pred[0]:.2f} minutes")
             except Exception:
                 st.error("⚠️ Please enter a valid part description seen in logs.")
 
         if st.button("Check Anomaly"):
             try:
-                result = anomaly_model.predict([[le_line.transform([pred_line])[0],
-                                                 le_activity.transform([pred_activity])[0],
-                                                 le_part.transform([pred_part])[0] if pred_part in le_part.classes_ else 0]])
+                buf[0, 0] = line_cats[pred_line]
+                buf[0, 1] = act_cats[pred_activity]
+                buf[0, 2] = part_cats.get(pred_part, 0)
+                with parallel_backend("threading", n_jobs=-1):
+                    result = anomaly_model.predict(buf)
                 if result[0] == -1:
                     st.warning("⚠️ This activity looks abnormal compared to history.")
                 else:
@@ -198,8 +441,6 @@ def app():
             except Exception:
                 st.error("⚠️ Unable to check anomaly for this input.")
 
-    conn.close()
-
 # -----------------------------
 # Run
 # -----------------------------